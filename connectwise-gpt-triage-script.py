@@ -1,24 +1,44 @@
 import os
-import requests
-from openai import OpenAI
+import asyncio
+import aiohttp
+import httpx
+import importlib.util
+from openai import AsyncOpenAI
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
 from urllib.parse import quote
 from dotenv import load_dotenv
 import base64
+import hashlib
+import orjson
+import ijson
+import redis
+import redis.asyncio
 import traceback
 
 # Load environment variables
 load_dotenv()
 
 # Configure logging
-logging.basicConfig(
-    filename='Logs.txt',
-    filemode='a',
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
+# Records are queued from the event loop and written to Logs.txt by a background listener thread
+log_queue = queue.Queue(-1)
+file_handler = logging.FileHandler('Logs.txt', mode='a')
+file_handler.setFormatter(logging.Formatter(
+    fmt='%(asctime)s [%(levelname)s] %(message)s',
     datefmt='%H:%M:%S'  # This formats the timestamp as HH:MM:SS
-)
+))
+log_listener = QueueListener(log_queue, file_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+# Attached directly rather than via basicConfig, which would give the QueueHandler its own formatter
+# and prefix every record twice
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
+root_logger.addHandler(QueueHandler(log_queue))
 
 company_id = os.getenv("CW_COMPANY_ID")
 public_key = os.getenv("CW_PUBLIC_KEY")
@@ -27,23 +47,196 @@ key_string = f"{company_id}+{public_key}:{private_key}"
 encoded_key = base64.b64encode(key_string.encode()).decode()
 CW_AUTHORIZATION_TOKEN = encoded_key
 
+# "basic" authenticates with the API member keys above, "bearer" with a pre-issued CW_BEARER_TOKEN
+AUTH_MODE = os.getenv("CW_AUTH_MODE", "basic").lower()
+if AUTH_MODE == "bearer":
+    CW_BEARER_TOKEN = os.getenv("CW_BEARER_TOKEN")
+    if not CW_BEARER_TOKEN:
+        raise ValueError("CW_AUTH_MODE is 'bearer' but CW_BEARER_TOKEN is not set")
+    CW_AUTHORIZATION = f"Bearer {CW_BEARER_TOKEN}"
+elif AUTH_MODE == "basic":
+    CW_AUTHORIZATION = f"basic {CW_AUTHORIZATION_TOKEN}"
+else:
+    raise ValueError(f"Unsupported CW_AUTH_MODE: {AUTH_MODE}")
+
 # Load credentials from .env
-client = OpenAI(api_key=f"{os.getenv("OPENAI_API_KEY")}")
+# HTTP/2 lets the concurrent triage calls multiplex over a single connection.
+# It needs the h2 package (httpx[http2]), so fall back to HTTP/1.1 when that isn't installed.
+client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=httpx.AsyncClient(
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=32)
+    )
+)
 CW_CLIENT_ID = os.getenv("CW_CLIENT_ID")
 CW_SITE = os.getenv("CW_SITE")
 CW_BOARD = "Service"
 TIME_WINDOW_MINUTES = 5 
+GPT_MODEL = "gpt-3.5-turbo"  # Replace with the appropriate model
+MAX_DESCRIPTION_CHARS = 4000
+
+# Optional Redis cache for GPT triage responses, keyed on the prompt contents.
+# The Redis server should run with maxmemory-policy allkeys-lfu so the most reused entries survive eviction.
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = redis.asyncio.Redis.from_url(REDIS_URL) if REDIS_URL else None
+TRIAGE_CACHE_TTL_SECONDS = 86400
+PLACEHOLDER_DESCRIPTIONS = ("Error fetching notes", "No notes available")
+TICKET_LIST_CACHE_TTL_SECONDS = 8
+NOTES_PAGE_SIZE = 1000
+NOTES_TICKET_GROUP_SIZE = 50
+CW_MAX_RETRIES = 3
+CW_MAX_RETRY_DELAY_SECONDS = 30
+# The semaphore and the aiohttp connection pool share one limit, so every pooled connection can be used
+CW_MAX_CONCURRENCY = int(os.getenv("CW_MAX_CONCURRENCY", "8"))
+CW_SEM = asyncio.Semaphore(CW_MAX_CONCURRENCY)
 
 # Define headers with clientId for authentication
 HEADERS = {
-    "Authorization": f"basic {CW_AUTHORIZATION_TOKEN}",
+    "Authorization": CW_AUTHORIZATION,
     "clientId": CW_CLIENT_ID,
     "Content-Type": "application/json",
     "Accept": "application/json"
 }
 
+# ConnectWise endpoint URLs, built once at import
+TICKETS_URL = f"{CW_SITE}/v4_6_release/apis/3.0/service/tickets"
+TICKET_NOTES_URL = f"{TICKETS_URL}/notes"
+NOTE_URL_FMT = (TICKETS_URL + "/{ticket_id}/notes").format
+
+# The ticket list conditions are static, so they are URL encoded once here
+TICKET_CONDITIONS = 'status/name="New" and board/name="Service" and owner/name=null and contact/name="Thegen Jackson"'
+ENCODED_CONDITIONS = quote(TICKET_CONDITIONS)
+TICKET_LIST_URL = f"{TICKETS_URL}?conditions={ENCODED_CONDITIONS}"
+TICKET_LIST_CACHE_KEY = f"cw:list:{ENCODED_CONDITIONS}"
+LAST_GOOD_TICKETS_KEY = f"{TICKET_LIST_CACHE_KEY}:last_good"
+
+
+# System prompt shared by every triage request, built once at import
+SYSTEM_PROMPT = (
+    "You are a triage analyst reviewing tickets submitted from ConnectWise Manage. "
+    "When a ticket is pasted, extract and return a structured analysis in the format below. "
+    "The tone must be formal, objective, and neutral. "
+    "The analysis should not include casual language, conversational phrasing (e.g., 'Thanks', 'Here's', 'I've reviewed'), or emojis. "
+    "The response should be suitable for internal technical documentation, "
+    "focusing on the issue at hand and addressing any non-urgent aspects appropriately. "
+    "Urgency should be assessed in a rational manner based on the nature of the request, "
+    "with criticality being evaluated relative to the operational environment. "
+    "For example, issues like email signature creation should not be categorized as urgent compared to system failures or security issues. "
+    "Triage Analysis should be thorough but concise, "
+    "offering explanations for verdicts without any informal phrasing or personal commentary. "
+    "Explanatory phrasing should focus on factual reasoning and professional justification of decisions. "
+    "Avoid introductory statements like 'this appears to be' or 'here’s what I found'. "
+    "Ensure that standard elements (e.g., stock images, legal disclaimers) are recognized as routine and non-urgent, "
+    "unless specific deviations or complications are stated. "
+    "Avoid assuming urgency based solely on customer input, particularly in non-critical cases. "
+    "Next Steps or Initial Troubleshooting Recommendations should be provided where applicable. "
+    "These steps should be actionable, practical, and based on a logical order of resolution. "
+    "They should focus on resolving the issue or providing guidance on how to proceed with further investigation. "
+    "Include any relevant resources, tools, or documentation links that may assist in the resolution. "
+    "Recommendations should be clear, precise, and professional. "
+    "Strictly no emojis to be used at all."
+)
+SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
+
+@asynccontextmanager
+async def cwRequest(session, method, url, **kwargs):
+    # Cap concurrent ConnectWise calls and back off on 429 so the async fan-out stays under the rate limit
+    for attempt in range(CW_MAX_RETRIES + 1):
+        async with CW_SEM:
+            async with session.request(method, url, **kwargs) as response:
+                if response.status != 429 or attempt == CW_MAX_RETRIES:
+                    yield response
+                    return
+
+                retry_after = response.headers.get("Retry-After", "")
+                delay = int(retry_after) if retry_after.isdigit() else 2 ** attempt
+
+                # Hand back the 429 rather than stall the whole run on a long Retry-After
+                if delay > CW_MAX_RETRY_DELAY_SECONDS:
+                    logging.warning(f"ConnectWise asked to wait {delay}s for {method} {url}, giving up")
+                    yield response
+                    return
+
+        logging.warning(f"ConnectWise rate limited {method} {url}, retrying in {delay}s")
+        await asyncio.sleep(delay)
+
+
+async def fetchTicketNotesGroup(session, ticket_ids):
+    # Fetch the notes for a group of tickets in one paginated query instead of one request per ticket
+    notes_by_ticket = {ticket_id: [] for ticket_id in ticket_ids}
+
+    conditions = "ticketId in (" + ",".join(str(ticket_id) for ticket_id in ticket_ids) + ")"
+    base_url = f"{TICKET_NOTES_URL}?conditions={quote(conditions)}&pageSize={NOTES_PAGE_SIZE}&orderBy=id"
+
+    # Page in a stable order so no note is skipped or repeated between pages
+    page = 1
+    while True:
+        async with cwRequest(session, "GET", f"{base_url}&page={page}") as notes_response:
+            notes_response.raise_for_status()
+            notes = orjson.loads(await notes_response.read())
+
+        # Bucket the notes client-side by the ticket they belong to
+        for note in notes:
+            notes_by_ticket.setdefault(note['ticketId'], []).append(note['text'])
+
+        if len(notes) < NOTES_PAGE_SIZE:
+            return notes_by_ticket
+        page += 1
+
+
+async def fetchTicketNotes(session, ticket_ids):
+    # Split the IDs into fixed-size groups so each conditions string stays within URL length limits
+    groups = [ticket_ids[i:i + NOTES_TICKET_GROUP_SIZE] for i in range(0, len(ticket_ids), NOTES_TICKET_GROUP_SIZE)]
+    group_results = await asyncio.gather(*(fetchTicketNotesGroup(session, group) for group in groups))
+
+    notes_by_ticket = {}
+    for group_notes in group_results:
+        notes_by_ticket.update(group_notes)
+    return notes_by_ticket
+
+
+async def fetchTicketList(session, url, cache_key):
+    # Reuse a very recent copy of the list so tight polling doesn't re-hit ConnectWise
+    cached_body = await getCachedValue(cache_key)
+    if cached_body is not None:
+        logging.info("Using cached ticket list response")
+        return orjson.loads(cached_body)
+
+    # Send GET request to the ConnectWise API
+    async with cwRequest(session, "GET", url) as response:
+        # Log response status before raising error
+        logging.info(f"Response Status Code: {response.status}")
+        if response.status != 200:
+            # Log the raw response body for non-200 responses without parsing it
+            error_body = await response.text()
+            logging.error(f"Error Response Body: {error_body[:2048]}")
+
+        response.raise_for_status()  # Raise error if the request fails (4xx or 5xx)
+
+        # Stream-parse the list and keep only the fields we use, so the full payload is never held in memory.
+        # Descriptions come from the batched notes query, so only the id and summary are needed here.
+        tickets = [
+            {'id': ticket['id'], 'summary': ticket['summary']}
+            async for ticket in ijson.items_async(response.content, 'item')
+        ]
+
+    await setCachedValue(cache_key, TICKET_LIST_CACHE_TTL_SECONDS, orjson.dumps(tickets))
+
+    return tickets
+
+
+async def loadLastGoodTickets():
+    # Serve the last good ticket list, even if stale, rather than dropping this polling cycle
+    last_good = await getCachedHash(LAST_GOOD_TICKETS_KEY)
+    if not last_good:
+        return []
+    logging.warning(f"ConnectWise unavailable, serving last good ticket list saved at {last_good[b'saved_at'].decode()}")
+    return orjson.loads(last_good[b"body"])
+
 
-def fetchNewTickets():
+async def fetchNewTickets(session):
     try:
         # Brisbane is UTC+10
         brisbane_offset = timezone(timedelta(hours=10))
@@ -56,73 +249,63 @@ def fetchNewTickets():
         time_cutoff_utc = time_cutoff_dt.astimezone(timezone.utc)
         time_cutoff_str = time_cutoff_utc.strftime('%Y-%m-%dT%H:%M:%SZ')
 
-        # Prepare the conditions string WITH brackets around the date
-        conditions = f'status/name="New" and board/name="Service" and owner/name=null and contact/name="Thegen Jackson"'
+        logging.info(f"Using conditions: {TICKET_CONDITIONS}")  # Log the conditions for debugging
+        logging.info(f"Requesting URL: {TICKET_LIST_URL}")  # Log the final URL
 
-        logging.info(f"Using conditions: {conditions}")  # Log the conditions for debugging
+        # Fetch the ticket list, reusing a cached copy where possible
+        tickets = await fetchTicketList(session, TICKET_LIST_URL, TICKET_LIST_CACHE_KEY)
 
-        # URL encode the conditions string
-        encoded_conditions = quote(conditions)
-
-        # Build the URL with the encoded conditions
-        url = f"{CW_SITE}/v4_6_release/apis/3.0/service/tickets?conditions={encoded_conditions}"
-        logging.info(f"Requesting URL: {url}")  # Log the final URL
-
-        # Send GET request to the ConnectWise API
-        response = requests.get(url, headers=HEADERS)
-
-        # Log response status before raising error
-        logging.info(f"Response Status Code: {response.status_code}")
-        if response.status_code != 200:
-            # Log response body for non-200 responses for more detailed errors
-            try:
-                logging.error(f"Error Response Body: {response.json()}")
-            except requests.exceptions.JSONDecodeError:
-                logging.error(f"Error Response Body (non-JSON): {response.text}")
-
-        response.raise_for_status()  # Raise error if the request fails (4xx or 5xx)
-
-        # Parse and return the ticket data
-        tickets = response.json()
         logging.info(f"Fetched {len(tickets)} ticket(s) from '{CW_BOARD}' board created since {time_cutoff_str}")
 
+        # Fetch the notes for every ticket in a single batched request
+        try:
+            notes_by_ticket = await fetchTicketNotes(session, [ticket['id'] for ticket in tickets])
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"Failed to fetch ticket notes: {e}")
+            notes_by_ticket = None
+
         # Create a list to hold the final ticket data with notes included
         tickets_with_notes = []
 
         for ticket in tickets:
-            ticket_id = ticket['id']
-            summary = ticket['summary']
-            description = ticket.get('description', "Description not available")  # Fallback if no description
-
-            # Fetch notes using the notes_href from the ticket
-            notes_url = ticket['_info'].get('notes_href') if '_info' in ticket else None
-            if notes_url:
-                notes_response = requests.get(notes_url, headers=HEADERS)
-                if notes_response.status_code == 200:
-                    notes = notes_response.json()
-                    note_texts = [note['text'] for note in notes]
-                    full_description = " ".join(note_texts) if note_texts else "No notes available"
-                else:
-                    full_description = "Error fetching notes"
+            if notes_by_ticket is None:
+                full_description = "Error fetching notes"
             else:
-                full_description = "No notes URL available"
+                note_texts = notes_by_ticket.get(ticket['id'], [])
+                # Keep only the most recent context so long threads don't inflate the GPT prompt
+                full_description = " ".join(note_texts)[-MAX_DESCRIPTION_CHARS:] if note_texts else "No notes available"
 
             # Prepare the ticket data with notes
             ticket_data = {
-                "Ticket ID": ticket_id,
-                "Summary": summary,
+                "Ticket ID": ticket['id'],
+                "Summary": ticket['summary'],
                 "Description": full_description  # Full description here
             }
 
             # Add the ticket data to the list
             tickets_with_notes.append(ticket_data)
 
+        # Keep the last good list, notes included, with no expiry so an outage can fall back to it.
+        # A list whose notes failed to load is not good, so it never replaces the stored copy.
+        if notes_by_ticket is not None:
+            await setCachedHash(LAST_GOOD_TICKETS_KEY, {
+                "body": orjson.dumps(tickets_with_notes),
+                "saved_at": datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+            })
+
         return tickets_with_notes
 
-    except requests.exceptions.RequestException as e:
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         logging.error(f"Failed to fetch tickets due to request error: {e}")
         # Log the traceback for detailed debugging
         logging.error(traceback.format_exc())
+
+        # Only fall back when ConnectWise is unreachable or failing server-side. A 4xx means the
+        # request itself is wrong, and replaying a stale list would triage tickets that may have moved on.
+        unreachable = isinstance(e, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+        server_error = isinstance(e, aiohttp.ClientResponseError) and e.status >= 500
+        if unreachable or server_error:
+            return await loadLastGoodTickets()
         return []
     except Exception as e:
         logging.error(f"An unexpected error occurred while fetching tickets: {e}")
@@ -130,40 +313,54 @@ def fetchNewTickets():
         return []
 
 
-def getTriageOutput(ticket):
+async def getCachedValue(key):
+    # A cache outage should never stop triage, so Redis errors are logged and treated as a miss
+    if redis_client is None:
+        return None
+    try:
+        return await redis_client.get(key)
+    except redis.RedisError as e:
+        logging.warning(f"Redis GET failed for {key}: {e}")
+        return None
+
+
+async def setCachedValue(key, ttl_seconds, value):
+    # A ttl_seconds of None stores the value with no expiry
+    if redis_client is None:
+        return
+    try:
+        await redis_client.set(key, value, ex=ttl_seconds)
+    except redis.RedisError as e:
+        logging.warning(f"Redis SET failed for {key}: {e}")
+
+
+async def getCachedHash(key):
+    if redis_client is None:
+        return {}
+    try:
+        return await redis_client.hgetall(key)
+    except redis.RedisError as e:
+        logging.warning(f"Redis HGETALL failed for {key}: {e}")
+        return {}
+
+
+async def setCachedHash(key, mapping):
+    if redis_client is None:
+        return
+    try:
+        await redis_client.hset(key, mapping=mapping)
+    except redis.RedisError as e:
+        logging.warning(f"Redis HSET failed for {key}: {e}")
+
+
+async def getTriageOutput(ticket):
     try:
         # Log the ticket structure to debug the issue
         logging.info(f"Ticket data structure: {ticket}")
 
-        # Proceed with existing logic, assuming the ticket structure is correct
-        system_prompt = (
-            "You are a triage analyst reviewing tickets submitted from ConnectWise Manage. "
-            "When a ticket is pasted, extract and return a structured analysis in the format below. "
-            "The tone must be formal, objective, and neutral. "
-            "The analysis should not include casual language, conversational phrasing (e.g., 'Thanks', 'Here's', 'I've reviewed'), or emojis. "
-            "The response should be suitable for internal technical documentation, "
-            "focusing on the issue at hand and addressing any non-urgent aspects appropriately. "
-            "Urgency should be assessed in a rational manner based on the nature of the request, "
-            "with criticality being evaluated relative to the operational environment. "
-            "For example, issues like email signature creation should not be categorized as urgent compared to system failures or security issues. "
-            "Triage Analysis should be thorough but concise, "
-            "offering explanations for verdicts without any informal phrasing or personal commentary. "
-            "Explanatory phrasing should focus on factual reasoning and professional justification of decisions. "
-            "Avoid introductory statements like 'this appears to be' or 'here’s what I found'. "
-            "Ensure that standard elements (e.g., stock images, legal disclaimers) are recognized as routine and non-urgent, "
-            "unless specific deviations or complications are stated. "
-            "Avoid assuming urgency based solely on customer input, particularly in non-critical cases. "
-            "Next Steps or Initial Troubleshooting Recommendations should be provided where applicable. "
-            "These steps should be actionable, practical, and based on a logical order of resolution. "
-            "They should focus on resolving the issue or providing guidance on how to proceed with further investigation. "
-            "Include any relevant resources, tools, or documentation links that may assist in the resolution. "
-            "Recommendations should be clear, precise, and professional. "
-            "Strictly no emojis to be used at all."
-        )
-
         # Check if the ticket contains the expected fields before accessing them
-        ticket_id = ticket.get('id', 'Unknown ID')
-        summary = ticket.get('summary', 'No summary available')
+        ticket_id = ticket.get('Ticket ID', 'Unknown ID')
+        summary = ticket.get('Summary', 'No summary available')
 
         # Log ticket id and summary for debugging
         logging.info(f"Ticket ID: {ticket_id}, Summary: {summary}")
@@ -184,11 +381,24 @@ Notes:
 Triage Analysis:
 """
 
-        response = client.chat.completions.create(model="gpt-3.5-turbo",  # Replace with the appropriate model
-        messages=[{"role": "system", "content": system_prompt},
+        # Return a cached triage if this exact prompt has already been analysed
+        cache_key = "triage:" + hashlib.sha256((GPT_MODEL + SYSTEM_PROMPT + user_prompt).encode()).hexdigest()
+        cached_output = await getCachedValue(cache_key)
+        if cached_output is not None:
+            logging.info(f"Using cached triage output for ticket {ticket_id}")
+            return cached_output.decode()
+
+        response = await client.chat.completions.create(model=GPT_MODEL,
+        messages=[SYSTEM_MSG,
                   {"role": "user", "content": user_prompt}])
 
-        return response.choices[0].message.content.strip()
+        triage_output = response.choices[0].message.content.strip()
+
+        # Placeholder descriptions carry no ticket context, so their triage is never cached
+        if full_description not in PLACEHOLDER_DESCRIPTIONS:
+            await setCachedValue(cache_key, TRIAGE_CACHE_TTL_SECONDS, triage_output)
+
+        return triage_output
 
     except KeyError as e:
         logging.error(f"KeyError: Missing key {e} in ticket data: {ticket}")
@@ -199,9 +409,9 @@ Triage Analysis:
 
 
 
-def postTicketNote(ticket_id, note_text):
+async def postTicketNote(session, ticket_id, note_text):
     try:
-        url = f"{CW_SITE}/v4_6_release/apis/3.0/service/tickets/{ticket_id}/notes"
+        url = NOTE_URL_FMT(ticket_id=ticket_id)
 
         # Payload to create the internal note
         note_payload = {
@@ -212,8 +422,8 @@ def postTicketNote(ticket_id, note_text):
         }
 
         # Make the POST request to create the note
-        response = requests.post(url, headers=HEADERS, json=note_payload)
-        response.raise_for_status()  # Raise error if the request fails (4xx or 5xx)
+        async with cwRequest(session, "POST", url, json=note_payload) as response:
+            response.raise_for_status()  # Raise error if the request fails (4xx or 5xx)
 
         logging.info(f"Posted internal triage note to ticket #{ticket_id}")
 
@@ -221,17 +431,31 @@ def postTicketNote(ticket_id, note_text):
         logging.error(f"Failed to post note to ticket #{ticket_id}: {e}\n{traceback.format_exc()}")
 
 
-def processTickets():
-    tickets = fetchNewTickets()
-    for ticket in tickets:
-        # Get triage output from GPT for the current ticket
-        triage_output = getTriageOutput(ticket)
+async def triageTicket(session, ticket):
+    # Get triage output from GPT for the current ticket
+    triage_output = await getTriageOutput(ticket)
+
+    # Post the GPT response as an internal note to ConnectWise
+    await postTicketNote(session, ticket['Ticket ID'], triage_output)
+
+
+async def processTickets():
+    # One session for the whole run so every ConnectWise request shares its connection pool
+    connector = aiohttp.TCPConnector(limit=CW_MAX_CONCURRENCY)
+    try:
+        async with aiohttp.ClientSession(headers=HEADERS, connector=connector) as session:
+            tickets = await fetchNewTickets(session)
 
-        # Post the GPT response as an internal note to ConnectWise
-        postTicketNote(ticket['id'], triage_output)
+            # Triage every ticket concurrently so the GPT calls and note posts overlap
+            await asyncio.gather(*(triageTicket(session, ticket) for ticket in tickets))
+    finally:
+        # Close the OpenAI HTTP/2 and Redis connection pools before asyncio.run tears down the loop
+        await client.close()
+        if redis_client is not None:
+            await redis_client.aclose()
 
 
 if __name__ == "__main__":
     logging.info("Starting ConnectWise PA CustomGPT Triage Process")
-    processTickets()
+    asyncio.run(processTickets())
     logging.info("Triage Process Completed")
\ No newline at end of file